@@ -3,18 +3,68 @@
 
 import logging
 import os
-
+import re
+import subprocess
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from k3handy import CalledProcessError
 from k3handy import cmdf
+from k3handy import command
 from k3handy import parse_flag
 from k3handy import pabs
 from k3str import to_utf8
 
 logger = logging.getLogger(__name__)
 
+_SEP = os.sep
+
+# flags used in this module are a handful of short str.
+_parse_flag_cached = lru_cache(maxsize=64)(parse_flag)
+
+
+def _parse_flag(*flags):
+    try:
+        return _parse_flag_cached(*flags)
+    except TypeError:
+        # unhashable flag, such as a list
+        return parse_flag(*flags)
+
 
 class Git(object):
 
-    def __init__(self, opt, gitpath=None, gitdir=None, working_dir=None, cwd=None, ctxmsg=None):
+    __slots__ = (
+        'opt',
+        'cwd',
+        'gitpath',
+        'ctxmsg',
+        '_skip_status_warmup',
+        '_ro_cache',
+        '_catfile_procs',
+        '_args_cache',
+        '_opt_base',
+        # required by weakref.finalize()
+        '__weakref__',
+    )
+
+    # max number of cached read-only command results
+    _ro_cache_size = 1024
+
+    # max bytes of names sent to ``cat-file --batch-check`` plus their
+    # replies, before reading the replies back. git does not read more names
+    # while its output is not read, thus it must be below the size of pipe
+    # buffer, or both sides block on a full pipe. The smallest default pipe
+    # buffer is 16K, on macOS.
+    _catfile_chunk_bytes = 8192
+
+    # file mode of tree items
+    _TREE_MODE = "040000"
+    _BLOB_MODE = "100644"
+
+    def __init__(self, opt, gitpath=None, gitdir=None, working_dir=None, cwd=None, ctxmsg=None,
+                 skip_status_warmup=False):
         self.opt = opt.clone()
         # gitdir and working_dir is specified and do not consider '-C' option
         if gitdir is not None:
@@ -27,13 +77,29 @@ class Git(object):
         self.gitpath = gitpath or "git"
         self.ctxmsg = ctxmsg
 
+        # do not run "git status" before "diff-index" in worktree_is_clean()
+        self._skip_status_warmup = skip_status_warmup
+
+        # results of read-only commands about a full hash, keyed by
+        # (args, flag). A ref name such as ``master`` may be moved by another
+        # ``Git`` or another process at any time, thus it is never cached.
+        self._ro_cache = OrderedDict()
+
+        # persistent ``git cat-file --batch*`` processes, started on demand.
+        # batch option -> (Popen, weakref.finalize)
+        self._catfile_procs = {}
+
+        self._invalidate_opt()
+
     # high level API
 
     def checkout(self, branch, flag='x'):
-        return self.cmdf("checkout", branch, flag=flag)
+        self.cache_clear()
+        return self._cmdf("checkout", branch, flag=flag)
 
     def fetch(self, name, flag=''):
-        return self.cmdf("fetch", name, flag=flag)
+        self.cache_clear()
+        return self._cmdf("fetch", name, flag=flag)
 
     def reset_to_commit(self, mode, target=None, flag='x'):
         """
@@ -42,19 +108,26 @@ class Git(object):
         if target is None:
             target = 'HEAD'
 
-        return self.cmdf('reset', '--' + mode, target, flag=flag)
+        self.cache_clear()
+        return self._cmdf('reset', '--' + mode, target, flag=flag)
 
     # worktree
 
     def worktree_is_clean(self, flag=''):
         """
         Return whether worktree is clean
+
+        ``diff-index`` does not refresh the stat info in index, thus
+        ``git status`` is run first to refresh it. Create Git with
+        ``skip_status_warmup=True`` to save this git process, if the index is
+        known to be up to date.
         """
-        # git bug: 
+        # git bug:
         # Without running 'git status' first, "diff-index" in our test does not
         # pass
-        self.cmdf("status", flag='')
-        code, _out, _err = self.cmdf("diff-index", "--quiet", "HEAD", "--", flag=flag)
+        if not self._skip_status_warmup:
+            self._cmdf("status", flag='')
+        code, _out, _err = self._cmdf("diff-index", "--quiet", "HEAD", "--", flag=flag)
         return code == 0
 
     # branch
@@ -63,50 +136,60 @@ class Git(object):
         """
         Returns the default remote name of a branch.
         """
-        return self.cmdf('config', '--get',
-                         'branch.{}.remote'.format(branch),
-                         flag=flag + 'n0')
+        return self._cmdf('config', '--get',
+                          f'branch.{branch}.remote',
+                          flag=flag + 'n0')
 
     def branch_default_upstream(self, branch, flag=''):
         """
         Returns the default upstream name of a branch,
         i.e., the default upstream for master is origin/master.
         """
-        return self.cmdf('rev-parse',
-                         '--abbrev-ref',
-                         '--symbolic-full-name',
-                         branch +'@{upstream}', 
-                         flag=flag + 'n0')
+        return self._cmdf('rev-parse',
+                          '--abbrev-ref',
+                          '--symbolic-full-name',
+                          branch +'@{upstream}',
+                          flag=flag + 'n0')
 
     def branch_set(self, branch, rev, flag='x'):
         """
         Set branch ref to specified ``rev``.
         """
 
-        self.cmdf('update-ref', 'refs/heads/{}'.format(branch), rev, flag=flag)
+        self.cache_clear()
+        self._cmdf('update-ref', f'refs/heads/{branch}', rev, flag=flag)
 
     def branch_list(self, scope='local', flag=''):
         """
         List branches
-        """
 
-        refs = self.ref_list(flag=parse_flag(flag))
+        Args:
+            scope(str): ``local`` to list local branches, such as ``master``.
+                ``remote`` to list remote branches, such as ``origin/master``.
+
+        Returns:
+            list: of sorted branch names.
+        """
 
-        res = []
         if scope == 'local':
             pref = 'refs/heads/'
-            for ref in refs.keys():
-                if ref.startswith(pref):
-                    res.append(ref[len(pref):])
+        elif scope == 'remote':
+            pref = 'refs/remotes/'
+        else:
+            return []
 
-        return sorted(res);
+        # git filters the refs and outputs them sorted by name
+        return self._cmdf('for-each-ref',
+                          '--format=%(refname:strip=2)',
+                          pref,
+                          flag=_parse_flag('xo', flag))
 
     def branch_common_base(self, branch, other, flag=''):
         """
         Find the common base of two branches
         """
 
-        return self.cmdf('merge-base', branch, other, flag=flag+'0')
+        return self._cmdf('merge-base', branch, other, flag=flag+'0')
 
     def branch_divergency(self, branch, upstream=None, flag=''):
         """
@@ -121,8 +204,13 @@ class Git(object):
 
         base = self.branch_common_base(branch, upstream, flag='x')
 
-        b_logs = self.cmdf("log", "--format=%H", base + '..' + branch, flag='xo')
-        u_logs = self.cmdf("log", "--format=%H", base + '..' + upstream, flag='xo')
+        # the two logs are independent, run them concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            b_future = executor.submit(self._cmdf, "log", "--format=%H", base + '..' + branch, flag='xo')
+            u_future = executor.submit(self._cmdf, "log", "--format=%H", base + '..' + upstream, flag='xo')
+
+            b_logs = b_future.result()
+            u_logs = u_future.result()
 
         return (base, b_logs, u_logs)
 
@@ -132,26 +220,27 @@ class Git(object):
         """
         Returns the branch HEAD pointing to.
         """
-        return self.cmdf('symbolic-ref', '--short', 'HEAD', flag=flag + 'n0')
+        return self._cmdf('symbolic-ref', '--short', 'HEAD', flag=flag + 'n0')
 
     # remote
 
     def remote_get(self, name, flag=''):
         # TODO: by default all func should raise
-        return self.cmdf("remote", "get-url", name, flag=flag + 'n0')
+        return self._cmdf("remote", "get-url", name, flag=flag + 'n0')
 
     def remote_add(self, name, url, flag='x', **options):
-        self.cmdf("remote", "add", name, url, **options, flag=flag)
+        self.cache_clear()
+        self._cmdf("remote", "add", name, url, **options, flag=flag)
 
     # blob
 
     def blob_new(self, f, flag=''):
-        return self.cmdf("hash-object", "-w", f, flag=flag + 'n0')
+        return self._cmdf("hash-object", "-w", f, flag=flag + 'n0')
 
     #  tree
 
     def tree_of(self, commit, flag=''):
-        return self.cmdf("rev-parse", commit + "^{tree}", flag=flag + 'n0')
+        return self._cached_cmdf(commit, "rev-parse", commit + "^{tree}", flag=flag + 'n0')
 
     def tree_commit(self, treeish, commit_message, parent_commits, flag='x'):
 
@@ -164,95 +253,196 @@ class Git(object):
         for c in parent_commits:
             parent_args.extend(['-p', c])
 
-        return self.cmdf('commit-tree', treeish, *parent_args,
+        return self._cmdf('commit-tree', treeish, *parent_args,
                          input=commit_message, flag=flag + 'n0')
 
-    def tree_items(self, treeish, name_only=False, with_size=False, flag='x'):
+    def tree_items(self, treeish, name_only=False, with_size=False, parsed=False, flag='x'):
+        """
+        List items in a tree.
+
+        Args:
+            parsed(bool): if True, return an ``OrderedDict`` of file name to
+                item parsed by ``treeitem_parse()``, instead of lines of
+                ``git ls-tree``. It can not be used with ``name_only``.
+
+        Returns:
+            list: of lines output by ``git ls-tree``, or ``OrderedDict`` if ``parsed`` is True.
+        """
+        if parsed and name_only:
+            raise ValueError("parsed can not be used with name_only")
+
         args = []
         if name_only:
             args.append("--name-only")
 
         if with_size:
             args.append("--long")
-        return self.cmdf("ls-tree", treeish, *args, flag=flag + 'no')
 
-    def tree_add_obj(self, cur_tree, path, treeish):
+        if not parsed:
+            return self._cached_cmdf(treeish, "ls-tree", treeish, *args, flag=flag + 'no')
 
-        sep = os.path.sep
+        d = self._tree_items_parsed(treeish, with_size=with_size, flag=flag)
+        if d is None:
+            return None
 
-        itms = self.tree_items(cur_tree)
+        # do not let caller modify the cached items
+        return OrderedDict((k, dict(v)) for k, v in d.items())
 
-        if sep not in path:
-            return self.tree_new_replace(itms, path, treeish, flag='x')
+    def _tree_items_parsed(self, treeish, with_size=False, flag='x'):
+        """
+        The same as ``tree_items(parsed=True)``, but returns the cached
+        ``OrderedDict`` itself. Caller must not modify it or the items in it.
+        """
+        key = ('tree_items_parsed', treeish, with_size)
+        d = self._cache_get(key)
+        if d is None:
+            itms = self.tree_items(treeish, with_size=with_size, flag=flag)
+            if itms is None:
+                return None
 
-        # a/b/c -> a, b/c
-        p0, left = path.split(sep, 1)
-        p0item = self.tree_find_item(cur_tree, fn=p0, typ="tree")
+            d = self._parse_items(itms)
+            if _is_full_hash(treeish):
+                self._cache_put(key, d)
 
-        if p0item is None:
+        return d
 
-            newsubtree = treeish
-            for p in reversed(left.split(sep)):
-                newsubtree = self.tree_new_replace([], p, newsubtree, flag='x')
-        else:
+    def tree_items_z(self, treeish, parsed=False):
+        """
+        List items in a tree with ``git ls-tree -z``, without decoding.
+        File names are output verbatim, no quoting and no ambiguity with
+        SP or TAB in names.
+
+        Args:
+            parsed(bool): if True, return tuples of ``(mode, type, object,
+                fn)`` instead of raw entries.
+
+        Returns:
+            list: of ``bytes`` entries such as ``b"100644 blob <object>\\t<fn>"``.
+        """
+        key = ('tree_items_z', treeish)
+        entries = self._cache_get(key)
+        if entries is None:
+            _, out, _ = command(self.gitpath, *self._args_cache, 'ls-tree', '-z', treeish,
+                                check=True, text=False, **self._opt_base)
+            # every entry is terminated by NUL
+            entries = out.split(b"\0")[:-1]
+            if _is_full_hash(treeish):
+                self._cache_put(key, entries)
+
+        if parsed:
+            return [_treeitem_parse_z(e) for e in entries]
+
+        return list(entries)
+
+    def tree_add_many(self, cur_tree, items):
+        """
+        Add several objects into tree ``cur_tree``.
+        Types of all objects are resolved in one round trip to git before
+        building any sub tree.
+
+        Args:
+            cur_tree(str): the tree to add objects into.
+
+            items(list): of ``(path, treeish)``.
+
+        Returns:
+            str: hash of the new tree.
+        """
+        self._objs_info([obj for _, obj in items])
+
+        for path, treeish in items:
+            cur_tree = self.tree_add_obj(cur_tree, path, treeish)
+
+        return cur_tree
+
+    def tree_add_obj(self, cur_tree, path, treeish):
+        """
+        Add object ``treeish`` at ``path`` into tree ``cur_tree``, creating
+        or replacing sub trees along the path.
+
+        Returns:
+            str: hash of the new tree.
+        """
+
+        names = path.split(_SEP)
 
-            subtree = p0item["object"]
-            newsubtree = self.tree_add_obj(subtree, left, treeish)
+        # descend: collect items of every tree along the path.
+        # a/b/c -> [(items of cur_tree, a), (items of a, b), (items of a/b, c)]
+        # raw lines are kept for tree_new_replace(), the lookup uses the
+        # cached parsed items.
+        stack = []
+        tree = cur_tree
+        for i, name in enumerate(names):
+            stack.append((self.tree_items(tree), name))
+            if i == len(names) - 1:
+                break
 
-        return self.tree_new_replace(itms, p0, newsubtree, flag='x')
+            itm = self._tree_items_parsed(tree).get(name)
+            if itm is None or itm["type"] != "tree":
+                # the rest of path does not exist, build it from empty trees
+                for n in names[i + 1:]:
+                    stack.append(([], n))
+                break
+
+            tree = itm["object"]
+
+        # ascend: build new trees bottom-up
+        obj = treeish
+        for itms, name in reversed(stack):
+            obj = self.tree_new_replace(itms, name, obj, flag='x')
+
+        return obj
 
     def tree_find_item(self, treeish, fn=None, typ=None):
-        for itm in self.tree_items(treeish):
-            itm = self.treeitem_parse(itm)
-            if fn is not None and itm["fn"] != fn:
-                continue
+        itms = self._tree_items_parsed(treeish)
+
+        if fn is not None:
+            itm = itms.get(fn)
+            if itm is None:
+                return None
+            itms = {fn: itm}
+
+        for itm in itms.values():
             if typ is not None and itm["type"] != typ:
                 continue
 
-            return itm
+            return dict(itm)
         return None
 
-    def treeitem_parse(self, line):
-
-        # git-ls-tree output:
-        #     <mode> SP <type> SP <object> TAB <file>
-        # This output format is compatible with what --index-info --stdin of git update-index expects.
-        # When the -l option is used, format changes to
-        #     <mode> SP <type> SP <object> SP <object size> TAB <file>
-        # E.g.:
-        # 100644 blob a668431ae444a5b68953dc61b4b3c30e066535a2    imsuperman
-        # 040000 tree a668431ae444a5b68953dc61b4b3c30e066535a2    foo
-
-        p, fn = line.split("\t", 1)
-
-        elts = p.split()
-        rst = {
-            "mode": elts[0],
-            "type": elts[1],
-            "object": elts[2],
-            "fn": fn,
-        }
-        if len(elts) == 4:
-            rst["size"] = elts[3]
+    def _parse_items(self, itms):
+        """
+        Parse lines of ``git ls-tree`` into an ``OrderedDict`` of file name to
+        parsed item.
+        """
+        d = OrderedDict()
+        for itm in map(_treeitem_parse, itms):
+            d[itm["fn"]] = itm
+        return d
 
-        return rst
+    def treeitem_parse(self, line):
+        return _treeitem_parse(line)
 
     def tree_new(self, itms, flag='x'):
 
-        treeish = self.cmdf("mktree", input="\n".join(itms), flag=flag + 'n0')
+        # mktree input is built with one join and passed as str: cmdf runs git
+        # in text mode and subprocess encodes the whole input once.
+        treeish = self._cmdf("mktree", input="\n".join(itms), flag=flag + 'n0')
         return treeish
 
     def tree_new_replace(self, itms, name, obj, mode=None, flag='x'):
 
         new_items = self.treeitems_replace_item(itms, name, obj, mode=mode)
-
-        new_treeish = self.cmdf("mktree", input="\n".join(new_items), flag=flag + 'n0')
-        return new_treeish
+        return self.tree_new(new_items, flag=flag)
 
     def treeitems_replace_item(self, itms, name, obj, mode=None):
 
-        new_items = [x for x in itms
-                     if self.treeitem_parse(x)["fn"] != name]
+        d = OrderedDict()
+        for line in itms:
+            # only the file name after TAB is needed
+            d[line.partition("\t")[2]] = line
+
+        d.pop(name, None)
+        new_items = list(d.values())
 
         if obj is not None:
             itm = self.treeitem_new(name, obj, mode=mode)
@@ -264,23 +454,17 @@ class Git(object):
 
     def treeitem_new(self, name, obj, mode=None):
 
-        typ = self.obj_type(obj, flag='x')
-        item_fmt = "{mode} {typ} {object}\t{name}"
+        typ = self.obj_type_batched(obj)
+        if typ is None:
+            # let git raise an error about the bad object
+            typ = self.obj_type(obj, flag='x')
 
         if typ == 'tree':
-            mod = "040000"
+            mod = self._TREE_MODE
         else:
-            if mode is None:
-                mod = "100644"
-            else:
-                mod = mode
+            mod = mode or self._BLOB_MODE
 
-        itm = item_fmt.format(mode=mod,
-                              typ=typ,
-                              object=obj,
-                              name=name
-                              )
-        return itm
+        return f"{mod} {typ} {obj}\t{name}"
 
     # ref
     
@@ -298,11 +482,11 @@ class Git(object):
         #  104403398142d4643669be8099697a6b51bbbc62 refs/remotes/origin/master
         #  4a90cdaec2e7bb945c9a49148919db0a6ffa059d refs/tags/v0.1.0
         #  b1af433f3291ff137679ad3889be5d72377f0cb6 refs/tags/v0.1.10
-        hash_and_refs = self.cmdf('show-ref', flag=parse_flag('xo', flag))
+        hash_and_refs = self._cmdf('show-ref', flag=_parse_flag('xo', flag))
 
         res = {}
         for line in hash_and_refs:
-            hsh, ref = line.strip().split()
+            hsh, _, ref = line.strip().partition(' ')
 
             res[ref] = hsh
 
@@ -323,33 +507,386 @@ class Git(object):
         Returns:
             str: sha256 in lower-case hex. If no such object is found, it returns None.
         """
-        return self.cmdf("rev-parse", "--verify", "--quiet", name, flag=flag + 'n0')
+        return self._cached_cmdf(name, "rev-parse", "--verify", "--quiet", name, flag=flag + 'n0')
+
+    def rev_of_many(self, names):
+        """
+        Get the revisions of several objects, the same as calling ``rev_of()``
+        for each of them, but all names are resolved by one persistent
+        ``git cat-file --batch-check`` process.
+        It raises ``CalledProcessError`` if the process exits, e.g., the repo
+        does not exist.
+
+        Args:
+            names(iterable): of object names, such as hash, ref name or branch.
+
+        Returns:
+            dict: of name to hash in lower-case hex, or None if no such object.
+        """
+        names = list(names)
+        infos = self._objs_info(names)
+
+        return {name: (info[0] if info is not None else None)
+                for name, info in zip(names, infos)}
 
     def obj_type(self, obj, flag=''):
-        return self.cmdf("cat-file", "-t", obj, flag=flag + 'n0')
+        return self._cached_cmdf(obj, "cat-file", "-t", obj, flag=flag + 'n0')
+
+    def obj_type_batched(self, obj):
+        """
+        Get the type of an object, the same as ``obj_type()`` but through a
+        persistent ``git cat-file --batch-check`` process, thus no new git
+        process is spawned for each object.
+
+        Returns:
+            str: one of ``blob``, ``tree``, ``commit`` and ``tag``. None if
+            no such object.
+        """
+        info = self._objs_info([obj])[0]
+        if info is None:
+            return None
+        return info[1]
+
+    def _objs_info(self, objs):
+        """
+        Resolve object names with the persistent ``cat-file --batch-check``
+        process.
+
+        Returns:
+            list: of ``(hash, type)`` for each name in ``objs``, or None if
+            there is no such object.
+        """
+
+        rst = [None] * len(objs)
+        missing = []
+
+        for i, obj in enumerate(objs):
+            if '\n' in obj:
+                # git reads names by line: such a name would get two replies
+                # and all later replies on the pipe would be off by one.
+                continue
+
+            info = self._cache_get(('obj_info', obj))
+            if info is not None:
+                rst[i] = info
+            else:
+                missing.append(i)
+
+        lines = self._catfile_batch_check([objs[i] for i in missing])
+        for i, line in zip(missing, lines):
+            # a bad name is output as "<name> missing" or "<name> ambiguous"
+            hsh, _, typ = line.partition(' ')
+            if typ not in ('blob', 'tree', 'commit', 'tag'):
+                continue
+            rst[i] = (hsh, typ)
+            if _is_full_hash(objs[i]):
+                self._cache_put(('obj_info', objs[i]), rst[i])
+
+        return rst
+
+    def _catfile_batch_check(self, objs):
+        """
+        Send object names to ``cat-file --batch-check`` and read back one
+        output line for each. Names are sent in chunks of at most
+        ``_catfile_chunk_bytes``, with one flush for each chunk.
+        """
+        batch_opt = '--batch-check=%(objectname) %(objecttype)'
+        proc = self._catfile_start(batch_opt)
+
+        lines = []
+        chunk = []
+        size = 0
+        for o in objs:
+            o = to_utf8(o) + b'\n'
+            # the reply is "<hash> <type>" of at most 72 bytes, or
+            # "<name> missing" or "<name> ambiguous" for a bad name
+            n = len(o) + max(len(o) + 10, 72)
+            if chunk and size + n > self._catfile_chunk_bytes:
+                lines.extend(self._catfile_send(batch_opt, proc, chunk))
+                chunk = []
+                size = 0
+
+            chunk.append(o)
+            size += n
+
+        if chunk:
+            lines.extend(self._catfile_send(batch_opt, proc, chunk))
+
+        return lines
+
+    def _catfile_send(self, batch_opt, proc, chunk):
+        """
+        Write LF terminated names in ``chunk`` with one flush and read back
+        one output line for each.
+        """
+        try:
+            proc.stdin.write(b''.join(chunk))
+            proc.stdin.flush()
+        except BrokenPipeError:
+            self._catfile_exited(batch_opt)
+
+        lines = []
+        for _ in chunk:
+            line = proc.stdout.readline()
+            if not line:
+                self._catfile_exited(batch_opt)
+            lines.append(line.decode('utf-8').rstrip('\n'))
+
+        return lines
+
+    def cat_file_batch(self, obj):
+        """
+        Read an object through a persistent ``git cat-file --batch`` process,
+        thus no new git process is spawned for each object.
+
+        Args:
+            obj(str): object name, such as hash, ``master`` or ``master:foo``.
+
+        Returns:
+            (str, str, bytes): hash, type and content of the object. None if
+            no such object. It raises ``CalledProcessError`` if the process
+            exits, e.g., the repo does not exist.
+        """
+        if '\n' in obj:
+            # git reads names by line, see _objs_info()
+            return None
+
+        batch_opt = '--batch'
+        proc = self._catfile_start(batch_opt)
+
+        try:
+            proc.stdin.write(to_utf8(obj) + b'\n')
+            proc.stdin.flush()
+        except BrokenPipeError:
+            self._catfile_exited(batch_opt)
+
+        # <hash> SP <type> SP <size> LF <content> LF
+        # or for a bad name, which may contain SP:
+        # <name> SP missing LF
+        # <name> SP ambiguous LF
+        line = proc.stdout.readline()
+        if not line:
+            self._catfile_exited(batch_opt)
+
+        line = line.decode('utf-8').rstrip('\n')
+        if line.endswith((' missing', ' ambiguous')):
+            return None
+
+        hsh, typ, size = line.split(' ')
+        size = int(size)
+        content = proc.stdout.read(size + 1)
+        if len(content) != size + 1:
+            self._catfile_exited(batch_opt)
+        content = content[:-1]
+
+        return (hsh, typ, content)
+
+    def _catfile_start(self, batch_opt):
+        if batch_opt in self._catfile_procs:
+            proc, finalizer = self._catfile_procs[batch_opt]
+            if proc.poll() is None:
+                return proc
+
+            # git has exited since the last call, start a new one
+            finalizer()
+
+        args = [self.gitpath, *self._args(), 'cat-file', batch_opt]
+        proc = subprocess.Popen(args,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                cwd=self.cwd)
+
+        # terminate it when this object is collected or at exit
+        finalizer = weakref.finalize(self, _close_proc, proc)
+        self._catfile_procs[batch_opt] = (proc, finalizer)
+
+        return proc
+
+    def _catfile_exited(self, batch_opt):
+        """
+        Clean up the ``cat-file`` process that exited while in use and raise.
+        """
+        proc, finalizer = self._catfile_procs.pop(batch_opt)
+        finalizer()
+
+        raise CalledProcessError(proc.returncode, '', '', proc.args, {'cwd': self.cwd})
+
+    def close(self):
+        """
+        Terminate the persistent git processes, if there are any.
+        They are started again when needed.
+        """
+        for _, finalizer in self._catfile_procs.values():
+            finalizer()
+
+        self._catfile_procs.clear()
+
+    # cache
+
+    def cache_clear(self):
+        """
+        Drop cached results of read-only commands.
+
+        Only lookups of a full hash are cached, which do not change when refs
+        are updated. Methods of this class that change the repo, and
+        ``Git.cmdf()``, clear the cache themselves. Call it after removing
+        objects by other means, e.g., by ``git gc`` in another process.
+        """
+        self._ro_cache.clear()
 
     # wrapper of cli
 
-    def _opt(self, **kwargs):
-        opt = {}
+    def _invalidate_opt(self):
+        """
+        Rebuild the cached command line arguments and options.
+        It must be called after ``self.opt`` or ``self.cwd`` is modified.
+        """
+        self._args_cache = tuple(self.opt.to_args())
+
+        self._opt_base = {}
         if self.cwd is not None:
-            opt["cwd"] = self.cwd
-        opt.update(kwargs)
-        return opt
+            self._opt_base["cwd"] = self.cwd
+
+        # results and the running process may belong to another repo
+        self.cache_clear()
+        self.close()
+
+    def _opt(self, **kwargs):
+        return {**self._opt_base, **kwargs}
 
     def _args(self):
-        return self.opt.to_args()
+        return self._args_cache
+
+    def _cached_cmdf(self, obj, *args, flag=''):
+        """
+        Run a read-only git command about ``obj`` and cache its result, if
+        ``obj`` is a full hash. A hash always names the same content, while
+        a ref name may be moved by another ``Git`` or another process.
+
+        Failures(None) are not cached, since a missing object may be
+        created later.
+        """
+        if not _is_full_hash(obj):
+            return self._cmdf(*args, flag=flag)
+
+        if isinstance(flag, list):
+            flag = tuple(flag)
+
+        key = (args, flag)
+        res = self._cache_get(key)
+        if res is None:
+            res = self._cmdf(*args, flag=flag)
+            if res is None:
+                return None
+
+            self._cache_put(key, res)
+
+        # do not let caller modify the cached list
+        if isinstance(res, list):
+            return list(res)
+        return res
+
+    def _cache_get(self, key):
+        """
+        Return the cached result of ``key`` and mark it as recently used, or
+        None if it is not cached.
+        """
+        res = self._ro_cache.get(key)
+        if res is not None:
+            self._ro_cache.move_to_end(key)
+        return res
+
+    def _cache_put(self, key, res):
+        if len(self._ro_cache) >= self._ro_cache_size:
+            # evict the least recently used entry
+            self._ro_cache.popitem(last=False)
+        self._ro_cache[key] = res
 
     def cmdf(self, *args, flag='', **kwargs):
-        return cmdf(self.gitpath, *self._args(), *args, flag=flag, **self._opt(**kwargs))
+        """
+        Run a git command.
+
+        The command may change the repo in any way, thus cached results are
+        dropped first.
+        """
+        self.cache_clear()
+        return self._cmdf(*args, flag=flag, **kwargs)
+
+    def _cmdf(self, *args, flag='', **kwargs):
+        """
+        Run a git command without dropping cached results.
+        Methods of this class that change the repo clear the cache themselves.
+        """
+        return cmdf(self.gitpath, *self._args_cache, *args, flag=flag, **self._opt(**kwargs))
 
     def out(self, fd, *msg):
 
+        # build the whole line and write it with one syscall
+        parts = []
         if self.ctxmsg is not None:
-            os.write(fd, to_utf8(self.ctxmsg) + b": ")
+            parts.append(to_utf8(self.ctxmsg) + b": ")
+
+        if all(isinstance(m, str) for m in msg):
+            # encode once for the joined line
+            parts.append(to_utf8(" ".join(msg)))
+        else:
+            # bytes are passed through unchanged
+            parts.append(b" ".join([to_utf8(m) for m in msg]))
+        parts.append(b"\n")
+
+        os.write(fd, b"".join(parts))
+
+
+# full hash of sha1 or sha256 repo
+_FULL_HASH_RE = re.compile(r'[0-9a-f]{40}|[0-9a-f]{64}')
+
+
+def _is_full_hash(name):
+    return _FULL_HASH_RE.fullmatch(name) is not None
+
+
+# git-ls-tree output:
+#     <mode> SP <type> SP <object> TAB <file>
+# This output format is compatible with what --index-info --stdin of git update-index expects.
+# When the -l option is used, format changes to
+#     <mode> SP <type> SP <object> SP <object size> TAB <file>
+# The size is padded with spaces, and is "-" for a tree.
+# E.g.:
+# 100644 blob a668431ae444a5b68953dc61b4b3c30e066535a2    imsuperman
+# 040000 tree a668431ae444a5b68953dc61b4b3c30e066535a2    foo
+_TREEITEM_RE = re.compile(r'^(\S+) (\S+) (\S+)(?: +(\S+))?\t(.*)$', re.DOTALL)
+
+
+def _treeitem_parse(line):
+
+    m = _TREEITEM_RE.match(line)
+    if m is None:
+        raise ValueError("invalid ls-tree line: " + repr(line))
+
+    rst = {
+        "mode": m[1],
+        "type": m[2],
+        "object": m[3],
+        "fn": m[5],
+    }
+    if m[4] is not None:
+        rst["size"] = m[4]
+
+    return rst
+
+
+def _treeitem_parse_z(entry):
+    # <mode> SP <type> SP <object> TAB <file>, all in bytes
+    mode_typ_obj, _, fn = entry.partition(b"\t")
+    mode, typ, obj = mode_typ_obj.split(b" ", 2)
+    return (mode, typ, obj, fn)
+
 
-        for (i, m) in enumerate(msg):
-            os.write(fd, to_utf8(m))
-            if i != len(msg) - 1:
-                os.write(fd, b" ")
-        os.write(fd, b"\n")
+def _close_proc(proc):
+    try:
+        proc.stdin.close()
+    except BrokenPipeError:
+        # git has exited, the unflushed input is dropped
+        pass
+    proc.stdout.close()
+    proc.wait()
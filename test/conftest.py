@@ -0,0 +1,12 @@
+def pytest_collection_modifyitems(session, config, items):
+    # Run test classes that leave testdata dirty last in their module, so that
+    # testdata is reset once at the end instead of between classes.
+    # Items of a module are kept together, or the module teardown would run
+    # in the middle of it.
+    # See ``BaseTest._mutates_repo`` in test_git.py.
+    modules = {}
+    for item in items:
+        modules.setdefault(item.module, len(modules))
+
+    items.sort(key=lambda item: (modules[item.module],
+                                 bool(getattr(item.cls, '_mutates_repo', False))))